@@ -6,31 +6,82 @@ release, or between two releases on the same branch.
 from __future__ import print_function
 
 import argparse
+import asyncio
+import json
 import os
 import re
+import tempfile
 from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial
 
 import requests
+from requests.adapters import HTTPAdapter, Retry
 
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 DEFAULT_BRANCH = "main"
 PUBLIC_GITHUB_URL = "https://github.com"
 PUBLIC_GITHUB_API_URL = "https://api.github.com"
-GitHubConfig = namedtuple("GitHubConfig", ["base_url", "api_url", "headers"])
+GITHUB_API_VERSION = "2022-11-28"
+GitHubConfig = namedtuple(
+    "GitHubConfig", ["base_url", "api_url", "session", "cache"]
+)
+
+# Responses are cached between runs following the XDG base directory spec
+DEFAULT_CACHE_PATH = os.path.join(
+    os.environ.get("XDG_CACHE_HOME", os.path.join("~", ".cache")),
+    "github-changelog",
+    "etags",
+)
+
+# Most responses cached per repository, the least recently used are dropped
+MAX_CACHE_ENTRIES = 500
+
+# Cached responses are grouped by the repository in their url
+REPO_URL_RE = re.compile(r"/repos/([^/]+)/([^/?#]+)")
+
+# Number of pull requests fetched per GraphQL query
+GRAPHQL_BATCH_SIZE = 50
+
+# Number of commits listed per page of the compare endpoint
+COMPARE_PAGE_SIZE = 100
+
+# Number of concurrent requests when fetching PR details over REST
+MAX_WORKERS = 8
+
+# Connections kept alive per host. Configs are shared, so several fetches
+# can run on the same session at once, e.g. with fetch_changes_async().
+# urllib3 only opens connections when needed, so a large pool costs nothing.
+POOL_MAXSIZE = 32
 
 Commit = namedtuple("Commit", ["sha", "message"])
 PullRequest = namedtuple("PullRequest", ["number", "title"])
 PullRequestDetails = namedtuple("PullRequestDetails", ["body", "labels"])
 ExtendedPullRequest = namedtuple("ExtendedPullRequest", ["pr", "details"])
 
-# Merge commits use a double linebreak between the branch name and the title
-MERGE_PR_RE = re.compile(r"^Merge pull request #([0-9]+) from .*\n\n(.*)")
+# Merge commits use a double linebreak between the branch name and the title.
+# Squash-and-merge commits use the PR title with the number in parentheses.
+# Both are tried, in that order, in a single match. The pattern is anchored
+# at the start of the message and only matches within lines, so it fails
+# fast on long commit messages.
+PR_RE = re.compile(
+    r"\A(?:"
+    r"Merge pull request #(?P<merge_number>[0-9]+) from [^\n]*\n\n"
+    r"(?P<merge_title>[^\n]*)"
+    r"|(?P<squash_title>[^\n]*) \(#(?P<squash_number>[0-9]+)\)"
+    r")"
+)
 
 # Merge commits of a release branch
-MERGE_RELEASE_PR_RE = re.compile(r"^Merge pull request #([0-9]+) from .*/release/.*\n\n(.*)")
-
-# Squash-and-merge commits use the PR title with the number in parentheses
-SQUASH_PR_RE = re.compile(r"^(.*) \(#([0-9]+)\).*")
+MERGE_RELEASE_PR_RE = re.compile(
+    r"\AMerge pull request #([0-9]+) from [^\n]*/release/[^\n]*"
+    r"\n\n([^\n]*)"
+)
 
 # Changelog Identifier Regex. Ex.: CHANGELOG: Added some stuff
 CHANGELOG_RE = re.compile(r"^CHANGELOG:\s?(.*)", re.MULTILINE)
@@ -46,6 +97,28 @@ LABEL_LEVELS = {
     "major": 1,
 }
 
+# PR labels grouped by level. A PR is a patch only if all its labels are.
+MAJOR_LABELS = frozenset(
+    label for label, level in LABEL_LEVELS.items() if level == 1
+)
+PATCH_LABELS = frozenset(
+    label for label, level in LABEL_LEVELS.items() if level == 3
+)
+
+# GraphQL selection for the details of a single PR, aliased per PR
+PR_DETAILS_QUERY = (
+    "pr{number}: pullRequest(number: {number}) "
+    "{{ body labels(first: 50) {{ nodes {{ name }} }} }}"
+)
+
+# GraphQL query for the commit of a lightweight or annotated tag
+TAG_COMMIT_QUERY = (
+    "query($owner: String!, $repo: String!, $ref: String!) "
+    "{ repository(owner: $owner, name: $repo) { ref(qualifiedName: $ref) "
+    "{ target { ... on Commit { oid } "
+    "... on Tag { target { ... on Commit { oid } } } } } } }"
+)
+
 CHANGELOG_LEVEL_MESSAGE = {
     1: "MAJOR RELEASE",
     2: "MINOR RELEASE",
@@ -57,39 +130,214 @@ class GitHubError(Exception):
     pass
 
 
-def get_github_config(github_base_url, github_api_url, token):
-    """Returns a GitHubConfig instance based on the given arguments"""
+class NoPullRequestsError(GitHubError):
+    """Raised when commits were found but none of them is a PR merge"""
+
+
+class ETagCache(object):
+    """Response bodies and their ETags, keyed by url
+
+    Responses are stored in one JSON file per repository under the path
+    directory, and a repository's file is only read once one of its urls is
+    requested. Urls outside of a repository aren't cached.
+    """
+
+    def __init__(self, path):
+        self.path = os.path.expanduser(path)
+        self.files = {}
+        self.changed = set()
+
+    def get_file_path(self, url):
+        """Get the path of the file caching the url, or None"""
+        match = REPO_URL_RE.search(url)
+        if match is None or not set(match.groups()).isdisjoint({".", ".."}):
+            return None
+        owner, repo = match.groups()
+        return os.path.join(self.path, owner, repo + ".json")
+
+    def load(self, file_path):
+        """Get the entries of a cache file, reading it on first use"""
+        if file_path not in self.files:
+            entries = {}
+            try:
+                with open(file_path) as cache_file:
+                    entries = json.load(cache_file)
+            except (OSError, ValueError):
+                pass
+            self.files[file_path] = entries
+        return self.files[file_path]
+
+    def get(self, url):
+        """Get the [etag, body] cached for the url, or None"""
+        file_path = self.get_file_path(url)
+        if file_path is None:
+            return None
+        entries = self.load(file_path)
+        entry = entries.pop(url, None)
+        if entry is not None:
+            # Entries are kept in least recently used order
+            entries[url] = entry
+        return entry
+
+    def set(self, url, etag, body):
+        file_path = self.get_file_path(url)
+        if file_path is None:
+            return
+        entries = self.load(file_path)
+        entries.pop(url, None)
+        entries[url] = [etag, body]
+        self.changed.add(file_path)
+
+    def save(self):
+        """Write the changed cache files to disk, ignoring failures
+
+        Only the MAX_CACHE_ENTRIES most recently used responses of each
+        repository are kept. Files are only readable by their owner, as they
+        can hold the bodies of private PRs.
+        """
+        for file_path in sorted(self.changed):
+            entries = self.files[file_path]
+            for url in list(entries)[:-MAX_CACHE_ENTRIES]:
+                del entries[url]
+
+            cache_dir = os.path.dirname(file_path)
+            try:
+                os.makedirs(self.path, mode=0o700, exist_ok=True)
+                os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+                # mkstemp creates the file with 0600 permissions, and
+                # replacing the file in one step never leaves it partially
+                # written
+                fd, tmp_path = tempfile.mkstemp(dir=cache_dir)
+                try:
+                    with os.fdopen(fd, "w") as cache_file:
+                        json.dump(entries, cache_file)
+                    os.replace(tmp_path, file_path)
+                except BaseException:
+                    os.unlink(tmp_path)
+                    raise
+            except OSError:
+                continue
+            self.changed.discard(file_path)
+
+
+class ETagCachingAdapter(HTTPAdapter):
+    """HTTPAdapter making conditional GET requests for cached responses
+
+    GitHub answers with 304 Not Modified when the ETag sent in If-None-Match
+    still matches, which doesn't count against the rate limit. The cached
+    body is then returned as a regular 200 response.
+    """
+
+    def __init__(self, cache, **kwargs):
+        self.cache = cache
+        super(ETagCachingAdapter, self).__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        if request.method != "GET":
+            return super(ETagCachingAdapter, self).send(request, **kwargs)
+
+        cached = self.cache.get(request.url)
+        if cached is not None:
+            request.headers["If-None-Match"] = cached[0]
+
+        response = super(ETagCachingAdapter, self).send(request, **kwargs)
+
+        if response.status_code == 304 and cached is not None:
+            # Consume the empty 304 body so its connection goes back to
+            # the pool instead of being dropped
+            response.content
+            response.close()
+            response.status_code = 200
+            response._content = cached[1].encode("utf-8")
+            response.encoding = "utf-8"
+        elif response.status_code == 200 and "ETag" in response.headers:
+            etag = response.headers["ETag"]
+            self.cache.set(request.url, etag, response.text)
+
+        return response
+
+
+def get_github_config(github_base_url, github_api_url, token, cache_path=None):
+    """Returns a GitHubConfig instance based on the given arguments
+
+    Responses to GET requests are cached in the cache_path file, if given.
+    """
     if token is None:
         token = os.environ.get("GITHUB_API_TOKEN")
 
-    headers = {}
+    return build_github_config(
+        github_base_url, github_api_url, token, cache_path
+    )
+
+
+@lru_cache(maxsize=32)
+def build_github_config(github_base_url, github_api_url, token, cache_path):
+    """Build a GitHubConfig, reusing the one built for the same arguments"""
+    headers = {
+        "Accept": "application/vnd.github+json",
+        "X-GitHub-Api-Version": GITHUB_API_VERSION,
+    }
     if token is not None:
         headers["Authorization"] = "token " + token
 
+    # Share one session between all requests so connections are kept alive
+    # and transient server errors are retried. Once retries run out the last
+    # response is returned, so it's reported as a GitHubError
+    session = requests.Session()
+    session.headers.update(headers)
+    adapter_kwargs = {
+        "pool_connections": 10,
+        "pool_maxsize": POOL_MAXSIZE,
+        "max_retries": Retry(
+            total=3,
+            backoff_factor=0.5,
+            status_forcelist=[502, 503, 504],
+            raise_on_status=False,
+        ),
+    }
+
+    cache = None
+    if cache_path is not None:
+        cache = ETagCache(cache_path)
+        adapter = ETagCachingAdapter(cache, **adapter_kwargs)
+    else:
+        adapter = HTTPAdapter(**adapter_kwargs)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+
     return GitHubConfig(
-        base_url=github_base_url, api_url=github_api_url, headers=headers
+        base_url=github_base_url,
+        api_url=github_api_url,
+        session=session,
+        cache=cache,
     )
 
 
+def decode_json(response):
+    """Decode the JSON body of a response, using orjson if installed"""
+    if orjson is not None:
+        return orjson.loads(response.content)
+    return response.json()
+
+
 def get_commit_for_tag(github_config, owner, repo, tag):
     """Get the commit sha for a given git tag"""
-    tag_url = "/".join(
-        [
-            github_config.api_url,
-            "repos",
-            owner,
-            repo,
-            "git",
-            "refs",
-            "tags",
-            tag,
-        ]
+    # GraphQL resolves annotated tags in a single request
+    if can_use_graphql(github_config):
+        try:
+            return get_commit_for_tag_graphql(github_config, owner, repo, tag)
+        except GitHubError:
+            # Older GitHub Enterprise versions lack GraphQL, use REST instead
+            pass
+
+    tag_url = (
+        f"{github_config.api_url}/repos/{owner}/{repo}/git/refs/tags/{tag}"
     )
     tag_json = {}
 
     while "object" not in tag_json or tag_json["object"]["type"] != "commit":
-        tag_response = requests.get(tag_url, headers=github_config.headers)
-        tag_json = tag_response.json()
+        tag_response = github_config.session.get(tag_url)
+        tag_json = decode_json(tag_response)
 
         if tag_response.status_code != 200:
             raise GitHubError(
@@ -105,13 +353,11 @@ def get_commit_for_tag(github_config, owner, repo, tag):
 
 def get_last_commit(github_config, owner, repo, branch=DEFAULT_BRANCH):
     """Get the last commit sha for the given repo and branch"""
-    commits_url = "/".join(
-        [github_config.api_url, "repos", owner, repo, "commits"]
-    )
-    commits_response = requests.get(
-        commits_url, params={"sha": branch}, headers=github_config.headers
+    commits_url = f"{github_config.api_url}/repos/{owner}/{repo}/commits"
+    commits_response = github_config.session.get(
+        commits_url, params={"sha": branch}
     )
-    commits_json = commits_response.json()
+    commits_json = decode_json(commits_response)
     if commits_response.status_code != 200:
         raise GitHubError(
             "Unable to get commits. {}".format(commits_json["message"])
@@ -122,109 +368,275 @@ def get_last_commit(github_config, owner, repo, branch=DEFAULT_BRANCH):
 
 def get_last_tag(github_config, owner, repo):
     """Get the last tag for the given repo"""
-    tags_url = "/".join([github_config.api_url, "repos", owner, repo, "tags"])
-    tags_response = requests.get(tags_url, headers=github_config.headers)
+    tags_url = f"{github_config.api_url}/repos/{owner}/{repo}/tags"
+    # Tags are listed newest first, so only the first one is needed
+    tags_response = github_config.session.get(tags_url, params={"per_page": 1})
     tags_response.raise_for_status()
-    tags_json = tags_response.json()
+    tags_json = decode_json(tags_response)
     return tags_json[0]["name"]
 
 
+def iter_commits_between(
+    github_config, owner, repo, first_commit, last_commit
+):
+    """Yield the commits between two commits, one page at a time
+
+    Only the sha and message of each commit are kept.
+    """
+    commits_url = (
+        f"{github_config.api_url}/repos/{owner}/{repo}"
+        f"/compare/{first_commit}...{last_commit}"
+    )
+    commits_seen = 0
+    page = 1
+
+    # The compare endpoint only lists a limited number of commits per page
+    while True:
+        commits_response = github_config.session.get(
+            commits_url, params={"per_page": COMPARE_PAGE_SIZE, "page": page}
+        )
+        commits_json = decode_json(commits_response)
+        if commits_response.status_code != 200:
+            raise GitHubError(
+                "Unable to get commits between {} and {}. {}".format(
+                    first_commit, last_commit, commits_json["message"]
+                )
+            )
+
+        if "commits" not in commits_json:
+            raise GitHubError(
+                "Commits not found between {} and {}.".format(
+                    first_commit, last_commit
+                )
+            )
+
+        page_commits = commits_json["commits"]
+        for c in page_commits:
+            yield Commit(c["sha"], c["commit"]["message"])
+        commits_seen += len(page_commits)
+
+        # Without a total, keep paginating until a short page
+        last_page = len(page_commits) < COMPARE_PAGE_SIZE
+        total_commits = commits_json.get("total_commits")
+        if last_page or (
+            total_commits is not None and commits_seen >= total_commits
+        ):
+            return
+
+        page += 1
+
+
 def get_commits_between(github_config, owner, repo, first_commit, last_commit):
     """Get a list of commits between two commits"""
-    commits_url = "/".join(
-        [
-            github_config.api_url,
-            "repos",
-            owner,
-            repo,
-            "compare",
-            first_commit + "..." + last_commit,
-        ]
+    return list(
+        iter_commits_between(
+            github_config, owner, repo, first_commit, last_commit
+        )
     )
-    commits_response = requests.get(commits_url, headers=github_config.headers)
-    commits_json = commits_response.json()
-    if commits_response.status_code != 200:
+
+
+def get_pr_details(github_config, owner, repo, pr_number):
+    """Get the body of the identified PR"""
+    pr_url = f"{github_config.api_url}/repos/{owner}/{repo}/pulls/{pr_number}"
+    pr_response = github_config.session.get(pr_url)
+    pr_json = decode_json(pr_response)
+    if pr_response.status_code != 200:
         raise GitHubError(
-            "Unable to get commits between {} and {}. {}".format(
-                first_commit, last_commit, commits_json["message"]
+            "Unable to get PR # {}. {}".format(pr_number, pr_json["message"])
+        )
+
+    labels = [label["name"] for label in pr_json["labels"]]
+
+    return PullRequestDetails(body=pr_json["body"], labels=labels)
+
+
+def get_graphql_url(github_config):
+    """Get the GraphQL endpoint for the configured API url"""
+    api_url = github_config.api_url.rstrip("/")
+    # GitHub Enterprise serves the REST API under /api/v3 and GraphQL
+    # under /api/graphql
+    if api_url.endswith("/v3"):
+        api_url = api_url[: -len("/v3")]
+    return f"{api_url}/graphql"
+
+
+def can_use_graphql(github_config):
+    """Determine whether or not GraphQL queries can be made"""
+    # GitHub's GraphQL API is only available to authenticated requests
+    return "Authorization" in github_config.session.headers
+
+
+def run_graphql_query(github_config, query, variables):
+    """Run a GraphQL query and return its data"""
+    graphql_response = github_config.session.post(
+        get_graphql_url(github_config),
+        json={"query": query, "variables": variables},
+    )
+    try:
+        graphql_json = decode_json(graphql_response)
+    except ValueError:
+        graphql_json = {}
+
+    if graphql_response.status_code != 200:
+        raise GitHubError(
+            "Unable to run GraphQL query. {}".format(
+                graphql_json.get("message")
             )
         )
 
-    if "commits" not in commits_json:
+    if graphql_json.get("errors"):
         raise GitHubError(
-            "Commits not found between {} and {}.".format(
-                first_commit, last_commit
+            "GraphQL query failed. {}".format(
+                " ".join(error["message"] for error in graphql_json["errors"])
             )
         )
 
-    commits = [
-        Commit(c["sha"], c["commit"]["message"])
-        for c in commits_json["commits"]
-    ]
-    return commits
+    return graphql_json["data"]
 
 
-def get_pr_details(github_config, owner, repo, pr_number):
-    """Get the body of the identified PR"""
-    pr_url = "/".join(
-        [
-            github_config.api_url,
-            "repos",
-            owner,
-            repo,
-            "pulls",
-            pr_number,
-        ]
-    )
-    pr_response = requests.get(pr_url, headers=github_config.headers)
-    pr_json = pr_response.json()
-    if pr_response.status_code != 200:
-        raise GitHubError(
-            "Unable to get PR # {}. {}".format(
-                pr_number, pr_response["message"]
+def get_pr_details_batch(github_config, owner, repo, pr_numbers):
+    """Get the details of the identified PRs using GraphQL
+
+    Returns a dict of PullRequestDetails keyed by PR number.
+    """
+    pr_numbers = list(pr_numbers)
+    details = {}
+
+    for start in range(0, len(pr_numbers), GRAPHQL_BATCH_SIZE):
+        end = start + GRAPHQL_BATCH_SIZE
+        batch = pr_numbers[start:end]
+        query = (
+            "query($owner: String!, $repo: String!) "
+            "{{ repository(owner: $owner, name: $repo) {{ {} }} }}".format(
+                " ".join(
+                    PR_DETAILS_QUERY.format(number=number) for number in batch
+                )
             )
         )
+        repository = run_graphql_query(
+            github_config, query, {"owner": owner, "repo": repo}
+        )["repository"]
+
+        for number in batch:
+            pr_json = repository["pr{}".format(number)]
+            labels = [label["name"] for label in pr_json["labels"]["nodes"]]
+            details[number] = PullRequestDetails(
+                body=pr_json["body"], labels=labels
+            )
 
-    labels = [label["name"] for label in pr_json["labels"]]
+    return details
 
-    return PullRequestDetails(body=pr_json["body"], labels=labels)
+
+def get_commit_for_tag_graphql(github_config, owner, repo, tag):
+    """Get the commit sha for a given git tag using GraphQL"""
+    repository = run_graphql_query(
+        github_config,
+        TAG_COMMIT_QUERY,
+        {"owner": owner, "repo": repo, "ref": "refs/tags/" + tag},
+    )["repository"]
+
+    target = (repository.get("ref") or {}).get("target") or {}
+    # Annotated tags point to a tag object that points to the commit
+    if "target" in target:
+        target = target["target"] or {}
+
+    if "oid" not in target:
+        raise GitHubError("Unable to resolve tag {} to a commit.".format(tag))
+
+    return target["oid"]
 
 
 def extract_changelog(pr_body):
     """Extracts the Changelog from the PR Body"""
-    if pr_body is None:
+    # Most PR bodies have no changelog line, skip the regex for those
+    if pr_body is None or "CHANGELOG:" not in pr_body:
         return None
-    try:
-        changelog_match = CHANGELOG_RE.search(pr_body)
-        [changelog] = changelog_match.groups()
-        return changelog
-    except:
+
+    changelog_match = CHANGELOG_RE.search(pr_body)
+    if changelog_match is None:
+        return None
+
+    [changelog] = changelog_match.groups()
+    return changelog
+
+
+def parse_pr(message):
+    """Given a commit message, extract the PR number and title
+
+    Returns None if the commit message isn't a PR merge.
+    """
+    match = PR_RE.match(message)
+    if match is None:
         return None
 
+    if match.group("merge_number") is not None:
+        number, title = match.group("merge_number", "merge_title")
+    else:
+        number, title = match.group("squash_number", "squash_title")
+    return PullRequest(number=int(number), title=title)
+
 
 def is_pr(message):
     """Determine whether or not a commit message is a PR merge"""
-    return MERGE_PR_RE.search(message) or SQUASH_PR_RE.search(message)
+    return parse_pr(message) is not None
+
 
 def is_release_merge(message):
-    return MERGE_RELEASE_PR_RE.search(message)
+    return MERGE_RELEASE_PR_RE.match(message)
+
 
 def extract_pr(message):
     """Given a PR merge commit message, extract the PR number and title"""
-    merge_match = MERGE_PR_RE.match(message)
-    squash_match = SQUASH_PR_RE.match(message)
-
-    if merge_match is not None:
-        number, title = merge_match.groups()
-        return PullRequest(number=number, title=title)
-    elif squash_match is not None:
-        title, number = squash_match.groups()
-        return PullRequest(number=number, title=title)
-
-    raise Exception("Commit isn't a PR merge, {}".format(message))
-
-
-def fetch_changes(
+    pr = parse_pr(message)
+    if pr is None:
+        raise Exception("Commit isn't a PR merge, {}".format(message))
+
+    return pr
+
+
+def iter_pr_details(github_config, owner, repo, pr_numbers):
+    """Yield the PullRequestDetails of the given PRs, in order
+
+    Details are fetched in batches, so they are yielded as soon as each
+    batch arrives instead of once every PR has been fetched.
+    """
+    pr_numbers = list(pr_numbers)
+    use_graphql = can_use_graphql(github_config)
+
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        for start in range(0, len(pr_numbers), GRAPHQL_BATCH_SIZE):
+            end = start + GRAPHQL_BATCH_SIZE
+            batch = pr_numbers[start:end]
+
+            details = None
+            if use_graphql:
+                try:
+                    details = get_pr_details_batch(
+                        github_config, owner, repo, batch
+                    )
+                except GitHubError:
+                    # Older GitHub Enterprise versions lack GraphQL, use
+                    # REST for this and the remaining batches instead
+                    use_graphql = False
+
+            if details is None:
+                details = dict(
+                    zip(
+                        batch,
+                        executor.map(
+                            lambda pr_number: get_pr_details(
+                                github_config, owner, repo, pr_number
+                            ),
+                            batch,
+                        ),
+                    )
+                )
+
+            for number in batch:
+                yield details[number]
+
+
+def iter_changes(
     github_config,
     owner,
     repo,
@@ -233,78 +645,150 @@ def fetch_changes(
     branch=DEFAULT_BRANCH,
     ignore_release_merge=False,
 ):
-    if previous_tag is None:
-        previous_tag = get_last_tag(github_config, owner, repo)
-    previous_commit = get_commit_for_tag(
-        github_config, owner, repo, previous_tag
-    )
+    """Yield an ExtendedPullRequest for each PR, newest first"""
+
+    def get_previous_commit():
+        tag = previous_tag
+        if tag is None:
+            tag = get_last_tag(github_config, owner, repo)
+        return get_commit_for_tag(github_config, owner, repo, tag)
+
+    # Both ends of the range are independent, so resolve them concurrently
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        previous_future = executor.submit(get_previous_commit)
+        if current_tag is not None:
+            current_commit = get_commit_for_tag(
+                github_config, owner, repo, current_tag
+            )
+        else:
+            current_commit = get_last_commit(
+                github_config, owner, repo, branch
+            )
+        previous_commit = previous_future.result()
 
-    current_commit = None
-    if current_tag is not None:
-        current_commit = get_commit_for_tag(
-            github_config, owner, repo, current_tag
-        )
-    else:
-        current_commit = get_last_commit(github_config, owner, repo, branch)
+    # Both tags point to the same commit, so nothing has changed
+    if previous_commit == current_commit:
+        return
 
-    commits_between = get_commits_between(
+    commits_between = iter_commits_between(
         github_config, owner, repo, previous_commit, current_commit
     )
 
     # Process the commit list looking for PR merges
-    prs = [extract_pr(c.message) for c in commits_between if is_pr(c.message) and (not ignore_release_merge or not is_release_merge(c.message))]
-
-    extended_prs = [
-        ExtendedPullRequest(
-            pr, get_pr_details(github_config, owner, repo, pr.number)
+    # PRs keyed by number, in the order of the commits
+    prs_by_number = {}
+    has_commits = False
+    for commit in commits_between:
+        has_commits = True
+        pr = parse_pr(commit.message)
+        if pr is None:
+            continue
+        if ignore_release_merge and is_release_merge(commit.message):
+            continue
+
+        # A PR can be referenced by more than one commit, e.g. when it is
+        # cherry-picked, so only look up its details once
+        if pr.number not in prs_by_number:
+            prs_by_number[pr.number] = pr
+
+    if not prs_by_number and has_commits:
+        raise NoPullRequestsError(
+            "Lots of commits and no PRs on branch {}".format(branch)
         )
-        for pr in prs
-    ]
 
-    if len(extended_prs) == 0 and len(commits_between) > 0:
-        raise Exception(
-            "Lots of commits and no PRs on branch {}".format(branch)
+    # Commits are listed oldest first, the changelog lists the newest first
+    prs = list(prs_by_number.values())[::-1]
+    details = iter_pr_details(
+        github_config, owner, repo, [pr.number for pr in prs]
+    )
+    for pr, pr_details in zip(prs, details):
+        yield ExtendedPullRequest(pr, pr_details)
+
+
+def fetch_changes(
+    github_config,
+    owner,
+    repo,
+    previous_tag=None,
+    current_tag=None,
+    branch=DEFAULT_BRANCH,
+    ignore_release_merge=False,
+):
+    """Return the list of ExtendedPullRequest, newest first"""
+    return list(
+        iter_changes(
+            github_config,
+            owner,
+            repo,
+            previous_tag,
+            current_tag,
+            branch,
+            ignore_release_merge,
         )
+    )
 
-    extended_prs.reverse()
-    return extended_prs
+
+async def fetch_changes_async(
+    github_config,
+    owner,
+    repo,
+    previous_tag=None,
+    current_tag=None,
+    branch=DEFAULT_BRANCH,
+    ignore_release_merge=False,
+):
+    """Fetch the changes without blocking the event loop
+
+    The requests are made from a worker thread sharing the config's
+    session, so the changes of several repos can be fetched concurrently
+    with asyncio.gather().
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        None,
+        partial(
+            fetch_changes,
+            github_config,
+            owner,
+            repo,
+            previous_tag,
+            current_tag,
+            branch,
+            ignore_release_merge,
+        ),
+    )
 
 
 def format_changes(github_config, owner, repo, prs, markdown=False):
-    """Format the list of prs in either text or markdown"""
+    """Format an iterable of prs in either text or markdown"""
     lines = []
     change_level = 3
+    pull_url = f"{github_config.base_url}/{owner}/{repo}/pull/"
     for extended_pr in prs:
         pr = extended_pr.pr
-        number = "#{number}".format(number=pr.number)
         if markdown:
-            link = "{github_url}/{owner}/{repo}/pull/{number}".format(
-                github_url=github_config.base_url,
-                owner=owner,
-                repo=repo,
-                number=pr.number,
-            )
-            number = "[{number}]({link})".format(number=number, link=link)
+            number = f"[#{pr.number}]({pull_url}{pr.number})"
+        else:
+            number = f"#{pr.number}"
 
         pr_changelog_description = extract_changelog(extended_pr.details.body)
 
-        if len(extended_pr.details.labels or []) == 0:
-            change_level = min(change_level, 2)
+        labels = set(extended_pr.details.labels or ())
+        if not labels.isdisjoint(MAJOR_LABELS):
+            pr_level = 1
+        elif labels and labels <= PATCH_LABELS:
+            pr_level = 3
+        else:
+            # PRs without labels, or with minor or unknown labels
+            pr_level = 2
+        change_level = min(change_level, pr_level)
 
-        for label in extended_pr.details.labels or []:
-            change_level = min(change_level, LABEL_LEVELS.get(label) or 2)
+        if pr_changelog_description is None:
+            pr_changelog_description = pr.title
+        lines.append(f"- {pr_changelog_description} {number}")
 
-        lines.append(
-            "- {description} {number}".format(
-                description=pr_changelog_description
-                if pr_changelog_description is not None
-                else pr.title,
-                number=number,
-            )
-        )
-    lines.insert(0, CHANGELOG_LEVEL_MESSAGE[change_level])
-
-    return lines
+    # The release level is only known once every PR has been seen
+    return [CHANGELOG_LEVEL_MESSAGE[change_level]] + lines
 
 
 def generate_changelog(
@@ -314,21 +798,39 @@ def generate_changelog(
     current_tag=None,
     markdown=False,
     single_line=False,
-    branch=None,
-    github_base_url=None,
-    github_api_url=None,
+    branch=DEFAULT_BRANCH,
+    github_base_url=PUBLIC_GITHUB_URL,
+    github_api_url=PUBLIC_GITHUB_API_URL,
     github_token=None,
     ignore_release_merge=False,
+    cache_path=None,
 ):
 
     github_config = get_github_config(
-        github_base_url, github_api_url, github_token
+        github_base_url, github_api_url, github_token, cache_path
     )
 
-    prs = fetch_changes(
-        github_config, owner, repo, previous_tag, current_tag, branch, ignore_release_merge
+    changes = iter_changes(
+        github_config,
+        owner,
+        repo,
+        previous_tag,
+        current_tag,
+        branch,
+        ignore_release_merge,
     )
-    lines = format_changes(github_config, owner, repo, prs, markdown=markdown)
+    try:
+        # PR details are fetched as the changes are formatted
+        lines = format_changes(
+            github_config, owner, repo, changes, markdown=markdown
+        )
+    finally:
+        if github_config.cache is not None:
+            github_config.cache.save()
+
+    # Without any PR there is no changelog to generate, only the header
+    if len(lines) == 1:
+        return ""
 
     separator = "\\n" if single_line else "\n"
     return separator.join(lines)
@@ -370,14 +872,14 @@ def main():
         "--branch",
         type=str,
         action="store",
-        default=DEFAULT_BRANCH,
+        default=argparse.SUPPRESS,
         help="Override the " "target branch (defaults to main)",
     )
     parser.add_argument(
         "--github-base-url",
         type=str,
         action="store",
-        default=PUBLIC_GITHUB_URL,
+        default=argparse.SUPPRESS,
         help="Override if you "
         "are using GitHub Enterprise. e.g. https://github."
         "my-company.com",
@@ -386,7 +888,7 @@ def main():
         "--github-api-url",
         type=str,
         action="store",
-        default=PUBLIC_GITHUB_API_URL,
+        default=argparse.SUPPRESS,
         help="Override if you "
         "are using GitHub Enterprise. e.g. https://github."
         "my-company.com/api/v3",
@@ -404,6 +906,22 @@ def main():
         action="store_true",
         help="Override if you don't want to add release merges on the changelog",
     )
+    parser.add_argument(
+        "--cache-path",
+        type=str,
+        action="store",
+        default=DEFAULT_CACHE_PATH,
+        help="Directory to cache GitHub responses in between runs "
+        "(defaults to "
+        "{})".format(DEFAULT_CACHE_PATH),
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_const",
+        dest="cache_path",
+        const=None,
+        help="Don't cache GitHub responses between runs",
+    )
 
     args = parser.parse_args()
 
@@ -0,0 +1,103 @@
+import json
+import os
+from unittest import mock
+
+import pytest
+
+from changelog import (
+    PUBLIC_GITHUB_API_URL,
+    PUBLIC_GITHUB_URL,
+    get_github_config,
+)
+
+
+FIXTURES_DIR = os.path.join(os.path.dirname(__file__), "fixtures")
+
+
+def build_response(json_body, status_code=200):
+    """Build a mocked response with the given JSON body"""
+    response = mock.MagicMock()
+    response.status_code = status_code
+    response.json.return_value = json_body
+    return response
+
+
+@pytest.fixture(autouse=True)
+def no_orjson():
+    """Decode mocked responses with response.json() instead of orjson"""
+    with mock.patch("changelog.orjson", None):
+        yield
+
+
+@pytest.fixture(autouse=True)
+def no_github_token():
+    """Keep the developer's GITHUB_API_TOKEN out of the tests"""
+    with mock.patch.dict(os.environ):
+        os.environ.pop("GITHUB_API_TOKEN", None)
+        yield
+
+
+@pytest.fixture(scope="session")
+def fake_github_config():
+    """A config for the public GitHub with a token, shared by all tests"""
+    return get_github_config(
+        PUBLIC_GITHUB_URL, PUBLIC_GITHUB_API_URL, "fake-github-token"
+    )
+
+
+@pytest.fixture
+def make_response():
+    """Factory of mocked responses: make_response(json_body, status_code)"""
+    return build_response
+
+
+@pytest.fixture
+def load_fixture():
+    """Load recorded GitHub responses from the fixtures directory"""
+
+    def load(name):
+        with open(os.path.join(FIXTURES_DIR, name)) as f:
+            return json.load(f)
+
+    return load
+
+
+@pytest.fixture
+def serve_fixture():
+    """Make a requests.Session.get side effect serving a fixture by url"""
+
+    def serve(fixture, api_url):
+        path_start = len(api_url)
+
+        def get(url, **kwargs):
+            path = url[path_start:].lstrip("/")
+            return build_response(fixture["get"][path])
+
+        return get
+
+    return serve
+
+
+@pytest.fixture
+def serve_graphql():
+    """Make a requests.Session.post side effect resolving tags by name
+
+    The ends of a range are resolved concurrently, so tags can't be served
+    in order. Any other query gets the PR details response.
+    """
+
+    def serve(tag_commits, pr_details_response=None):
+        tag_start = len("refs/tags/")
+
+        def post(url, json, **kwargs):
+            ref = json["variables"].get("ref")
+            if ref is None:
+                return pr_details_response
+            oid = tag_commits[ref[tag_start:]]
+            return build_response(
+                {"data": {"repository": {"ref": {"target": {"oid": oid}}}}}
+            )
+
+        return post
+
+    return serve
@@ -1,461 +1,1052 @@
 # -*- coding: utf-8 -*-
 
-from unittest import TestCase
+import asyncio
+import io
+import os
+import tempfile
+from unittest import mock
 
-import mock
+import pytest
+import requests
+from urllib3.response import HTTPResponse
 
 from changelog import (
+    DEFAULT_BRANCH,
+    POOL_MAXSIZE,
     PUBLIC_GITHUB_API_URL,
     PUBLIC_GITHUB_URL,
-    GitHubError,
+    ETagCache,
+    ETagCachingAdapter,
     ExtendedPullRequest,
-    PullRequestDetails,
+    GitHubError,
+    NoPullRequestsError,
     PullRequest,
+    PullRequestDetails,
+    decode_json,
+    extract_changelog,
     extract_pr,
+    fetch_changes,
+    fetch_changes_async,
     format_changes,
     generate_changelog,
     get_commit_for_tag,
+    get_commit_for_tag_graphql,
     get_commits_between,
     get_github_config,
+    get_graphql_url,
     get_last_commit,
+    get_last_tag,
     get_pr_details,
+    get_pr_details_batch,
     is_pr,
+    iter_commits_between,
+    iter_pr_details,
+    parse_pr,
 )
 
 
-fake_github_config = get_github_config(
-    PUBLIC_GITHUB_URL, PUBLIC_GITHUB_API_URL, "fake-github-token"
-)
+def test_get_github_config():
+    """Tests that exercise get_github_config()"""
+    api_headers = {
+        "Accept": "application/vnd.github+json",
+        "X-GitHub-Api-Version": "2022-11-28",
+    }
+    create_args_to_outputs = [
+        [
+            # when token=None, headers should only set the API version
+            ("base-url", "api-url", None),
+            {"base_url": "base-url", "api_url": "api-url"},
+            api_headers,
+        ],
+        [
+            # when a token is provided, headers should be non-empty
+            ("base-url", "api-url", "secret-value"),
+            {"base_url": "base-url", "api_url": "api-url"},
+            dict(api_headers, Authorization="token secret-value"),
+        ],
+    ]
+    for create_args, expected_output, headers in create_args_to_outputs:
+        github_config = get_github_config(*create_args)
 
+        # note _asdict() is actually a documented "public" method
+        # despite its leading underscore
+        github_config_dict = github_config._asdict()
+        session = github_config_dict.pop("session")
+        assert github_config_dict.pop("cache") is None
+        assert github_config_dict == expected_output
+        for name, value in headers.items():
+            assert session.headers[name] == value
 
-class TestChangelog(TestCase):
-    def setUp(self):
-        pass
 
-    def test_get_github_config(self):
-        """Tests that exercise get_github_config()"""
-        create_args_to_outputs = [
-            [
-                # when token=None, headers should be an empty dict
-                ("base-url", "api-url", None),
-                {"base_url": "base-url", "api_url": "api-url", "headers": {}},
-            ],
-            [
-                # when a token is provided, headers should be non-empty
-                ("base-url", "api-url", "secret-value"),
-                {
-                    "base_url": "base-url",
-                    "api_url": "api-url",
-                    "headers": {"Authorization": "token secret-value"},
-                },
-            ],
+def test_get_github_config_session():
+    """Test the session retries transient errors on GitHub requests"""
+    github_config = get_github_config("base-url", "api-url", None)
+    adapter = github_config.session.get_adapter(PUBLIC_GITHUB_API_URL)
+    assert adapter.max_retries.total == 3
+    assert 502 in adapter.max_retries.status_forcelist
+    assert adapter.max_retries.raise_on_status is False
+    assert adapter.poolmanager.connection_pool_kw["maxsize"] == POOL_MAXSIZE
+
+
+def test_get_github_config_reused():
+    """Test the config is built once for the same arguments"""
+    github_config = get_github_config("base-url", "api-url", "secret")
+    assert get_github_config("base-url", "api-url", "secret") is github_config
+    assert (
+        get_github_config("base-url", "api-url", "other") is not github_config
+    )
+
+
+def test_etag_cache_save():
+    """Test the ETag cache is written to disk and read back"""
+    url = "https://api.github.com/repos/someone/one-repo/tags"
+    with tempfile.TemporaryDirectory() as cache_dir:
+        cache_path = os.path.join(cache_dir, "github-changelog")
+        cache = ETagCache(cache_path)
+        assert cache.get(url) is None
+
+        cache.set(url, '"etag"', '{"foo": 1}')
+        cache.save()
+
+        assert ETagCache(cache_path).get(url) == ['"etag"', '{"foo": 1}']
+
+        # Each repository has its own file, which can hold private PR bodies
+        file_path = os.path.join(cache_path, "someone", "one-repo.json")
+        assert os.stat(file_path).st_mode & 0o777 == 0o600
+        assert os.listdir(os.path.dirname(file_path)) == ["one-repo.json"]
+
+
+def test_etag_cache_per_repo():
+    """Test only the file of the requested repository is read"""
+    with tempfile.TemporaryDirectory() as cache_dir:
+        cache = ETagCache(cache_dir)
+        cache.set("https://api.github.com/repos/someone/one/tags", "", "")
+        cache.set("https://api.github.com/repos/someone/two/tags", "", "")
+        cache.set("https://api.github.com/rate_limit", '"etag"', "{}")
+        cache.save()
+
+        cache = ETagCache(cache_dir)
+        cache.get("https://api.github.com/repos/someone/one/tags")
+        assert list(cache.files) == [
+            os.path.join(cache_dir, "someone", "one.json")
         ]
-        for create_args, expected_output in create_args_to_outputs:
-            github_config = get_github_config(*create_args)
-
-            # note _asdict() is actually a documented "public" method
-            # despite its leading underscore
-            self.assertEqual(github_config._asdict(), expected_output)
-
-    @mock.patch("requests.get")
-    def test_get_commit_for_tag_exists(self, mock_requests_get):
-        """Test getting the commit sha for a tag if the tag exists"""
-        response = mock.MagicMock()
-        response.status_code = 200
-        response.json.return_value = {
-            "object": {"type": "commit", "sha": "0123456789abcdef"}
-        }
-        mock_requests_get.return_value = response
-        result = get_commit_for_tag(
-            fake_github_config, "someone", "one-repo", "mytag"
+        assert cache.get("https://api.github.com/rate_limit") is None
+
+
+@mock.patch("changelog.MAX_CACHE_ENTRIES", 2)
+def test_etag_cache_save_prunes():
+    """Test only the most recently used responses are saved"""
+    url = "https://api.github.com/repos/someone/one-repo/"
+    with tempfile.TemporaryDirectory() as cache_dir:
+        cache = ETagCache(cache_dir)
+        cache.set(url + "a", '"a"', "{}")
+        cache.set(url + "b", '"b"', "{}")
+        cache.get(url + "a")
+        cache.set(url + "c", '"c"', "{}")
+        cache.save()
+
+        file_path = os.path.join(cache_dir, "someone", "one-repo.json")
+        assert list(ETagCache(cache_dir).load(file_path)) == [
+            url + "a",
+            url + "c",
+        ]
+
+
+@mock.patch("requests.adapters.HTTPAdapter.send")
+def test_etag_caching_adapter_stores_response(mock_send):
+    """Test responses with an ETag are stored in the cache"""
+    response = requests.Response()
+    response.status_code = 200
+    response.headers["ETag"] = '"etag"'
+    response._content = b'{"foo": 1}'
+    mock_send.return_value = response
+
+    cache = ETagCache(os.devnull)
+    adapter = ETagCachingAdapter(cache)
+    request = requests.Request("GET", "https://api.github.com/repos/a/b")
+    adapter.send(request.prepare())
+
+    assert cache.get("https://api.github.com/repos/a/b") == [
+        '"etag"',
+        '{"foo": 1}',
+    ]
+
+
+@mock.patch("requests.adapters.HTTPAdapter.send")
+def test_etag_caching_adapter_not_modified(mock_send):
+    """Test the cached body is returned when GitHub answers 304"""
+    response = requests.Response()
+    response.status_code = 304
+    response._content = b""
+    mock_send.return_value = response
+
+    cache = ETagCache(os.devnull)
+    cache.set("https://api.github.com/repos/a/b", '"etag"', '{"foo": 1}')
+    adapter = ETagCachingAdapter(cache)
+    request = requests.Request("GET", "https://api.github.com/repos/a/b")
+    result = adapter.send(request.prepare())
+
+    assert mock_send.call_args[0][0].headers["If-None-Match"] == '"etag"'
+    assert result.status_code == 200
+    assert result.json() == {"foo": 1}
+
+
+@mock.patch("requests.adapters.HTTPAdapter.send")
+def test_etag_caching_adapter_not_modified_releases_connection(mock_send):
+    """Test the connection of a 304 goes back to the pool"""
+    pool = mock.MagicMock()
+    connection = mock.MagicMock()
+    response = requests.Response()
+    response.status_code = 304
+    response.raw = HTTPResponse(
+        body=io.BytesIO(b""),
+        status=304,
+        preload_content=False,
+        connection=connection,
+        pool=pool,
+    )
+    mock_send.return_value = response
+
+    cache = ETagCache(os.devnull)
+    cache.set("https://api.github.com/repos/a/b", '"etag"', '{"foo": 1}')
+    adapter = ETagCachingAdapter(cache)
+    request = requests.Request("GET", "https://api.github.com/repos/a/b")
+    result = adapter.send(request.prepare())
+
+    assert result.json() == {"foo": 1}
+    pool._put_conn.assert_called_once_with(connection)
+
+
+@mock.patch("requests.adapters.HTTPAdapter.send")
+def test_get_commit_for_tag_etag_304(mock_send):
+    """Test an unchanged tag is resolved from the ETag cache"""
+    response = requests.Response()
+    response.status_code = 304
+    response._content = b""
+    mock_send.return_value = response
+
+    tag_url = PUBLIC_GITHUB_API_URL + "/repos/someone/repo/git/refs/tags/1"
+    with tempfile.TemporaryDirectory() as cache_dir:
+        github_config = get_github_config(
+            PUBLIC_GITHUB_URL,
+            PUBLIC_GITHUB_API_URL,
+            None,
+            os.path.join(cache_dir, "etags.json"),
         )
-        self.assertEqual(result, "0123456789abcdef")
-
-    @mock.patch("requests.get")
-    def test_get_commit_for_tag_not_found(self, mock_requests_get):
-        """Getting commit sha for a tag fails if tag doesn't exist"""
-        response = mock.MagicMock()
-        response.status_code = 404
-        response.json.return_value = {"message": "nope"}
-        mock_requests_get.return_value = response
-        with self.assertRaises(GitHubError):
-            get_commit_for_tag(
-                fake_github_config, "someone", "one-repo", "mytag"
-            )
+        github_config.cache.set(
+            tag_url, '"etag"', '{"object": {"type": "commit", "sha": "a"}}'
+        )
+        result = get_commit_for_tag(github_config, "someone", "repo", "1")
+
+    assert result == "a"
+    assert mock_send.call_count == 1
+    assert mock_send.call_args[0][0].headers["If-None-Match"] == '"etag"'
+
+
+def test_decode_json():
+    """Test decoding a JSON response with the standard library"""
+    response = mock.MagicMock()
+    response.json.return_value = {"foo": 1}
+    assert decode_json(response) == {"foo": 1}
+
+
+@mock.patch("changelog.orjson")
+def test_decode_json_orjson(mock_orjson):
+    """Test decoding a JSON response with orjson when installed"""
+    response = mock.MagicMock()
+    response.content = b'{"foo": 1}'
+    mock_orjson.loads.return_value = {"foo": 1}
+    assert decode_json(response) == {"foo": 1}
+    mock_orjson.loads.assert_called_once_with(b'{"foo": 1}')
+    response.json.assert_not_called()
+
 
-    @mock.patch("requests.get")
-    def test_get_commit_for_tag_tag_object(self, mock_requests_get):
-        """Test getting the commit sha when tagged object is itself a tag"""
-        response = mock.MagicMock()
-        response.status_code = 200
-        response.json.side_effect = [
-            {
-                "object": {
-                    "type": "tag",
-                    "sha": "abcdef0123456789",
-                    "url": "http://foo",
+@mock.patch("requests.Session.post")
+@mock.patch("requests.Session.get")
+def test_get_commit_for_tag_exists(
+    mock_requests_get, mock_requests_post, fake_github_config, make_response
+):
+    """Test getting the commit sha for a tag if the tag exists"""
+    # GraphQL is unavailable so the tag is resolved with REST
+    mock_requests_post.return_value.status_code = 404
+
+    response = make_response(
+        {"object": {"type": "commit", "sha": "0123456789abcdef"}}
+    )
+    mock_requests_get.return_value = response
+    result = get_commit_for_tag(
+        fake_github_config, "someone", "one-repo", "mytag"
+    )
+    assert result == "0123456789abcdef"
+
+
+@mock.patch("requests.Session.post")
+@mock.patch("requests.Session.get")
+def test_get_commit_for_tag_not_found(
+    mock_requests_get, mock_requests_post, fake_github_config, make_response
+):
+    """Getting commit sha for a tag fails if tag doesn't exist"""
+    # GraphQL is unavailable so the tag is resolved with REST
+    mock_requests_post.return_value.status_code = 404
+
+    response = make_response({"message": "nope"}, status_code=404)
+    mock_requests_get.return_value = response
+    with pytest.raises(GitHubError):
+        get_commit_for_tag(fake_github_config, "someone", "one-repo", "mytag")
+
+
+@mock.patch("requests.Session.post")
+@mock.patch("requests.Session.get")
+def test_get_commit_for_tag_tag_object(
+    mock_requests_get, mock_requests_post, fake_github_config
+):
+    """Test getting the commit sha when tagged object is itself a tag"""
+    # GraphQL is unavailable so the tag is resolved with REST
+    mock_requests_post.return_value.status_code = 404
+
+    response = mock.MagicMock()
+    response.status_code = 200
+    response.json.side_effect = [
+        {
+            "object": {
+                "type": "tag",
+                "sha": "abcdef0123456789",
+                "url": "http://foo",
+            }
+        },
+        {"object": {"type": "commit", "sha": "0123456789abcdef"}},
+    ]
+    mock_requests_get.return_value = response
+    result = get_commit_for_tag(
+        fake_github_config, "someone", "one-repo", "mytag"
+    )
+    assert result == "0123456789abcdef"
+
+
+@mock.patch("requests.Session.post")
+def test_get_commit_for_tag_graphql(
+    mock_requests_post, fake_github_config, make_response
+):
+    """Test getting the commit sha for a tag with GraphQL"""
+    response = make_response(
+        {
+            "data": {
+                "repository": {"ref": {"target": {"oid": "0123456789abcdef"}}}
+            }
+        }
+    )
+    mock_requests_post.return_value = response
+    result = get_commit_for_tag(
+        fake_github_config, "someone", "one-repo", "mytag"
+    )
+    assert result == "0123456789abcdef"
+    assert mock_requests_post.call_args[1]["json"]["variables"] == {
+        "owner": "someone",
+        "repo": "one-repo",
+        "ref": "refs/tags/mytag",
+    }
+
+
+@mock.patch("requests.Session.post")
+def test_get_commit_for_tag_graphql_tag_object(
+    mock_requests_post, fake_github_config, make_response
+):
+    """Test getting the commit sha of an annotated tag with GraphQL"""
+    response = make_response(
+        {
+            "data": {
+                "repository": {
+                    "ref": {"target": {"target": {"oid": "0123456789abcdef"}}}
                 }
-            },
-            {"object": {"type": "commit", "sha": "0123456789abcdef"}},
-        ]
-        mock_requests_get.return_value = response
-        result = get_commit_for_tag(
+            }
+        }
+    )
+    mock_requests_post.return_value = response
+    result = get_commit_for_tag(
+        fake_github_config, "someone", "one-repo", "mytag"
+    )
+    assert result == "0123456789abcdef"
+
+
+@mock.patch("requests.Session.post")
+def test_get_commit_for_tag_graphql_not_found(
+    mock_requests_post, fake_github_config, make_response
+):
+    """Resolving a tag with GraphQL fails if the tag doesn't exist"""
+    response = make_response({"data": {"repository": {"ref": None}}})
+    mock_requests_post.return_value = response
+    with pytest.raises(GitHubError):
+        get_commit_for_tag_graphql(
             fake_github_config, "someone", "one-repo", "mytag"
         )
-        self.assertEqual(result, "0123456789abcdef")
-
-    @mock.patch("requests.get")
-    def test_get_last_commit_exists(self, mock_requests_get):
-        """Test getting commit sha for latest commit on the default branch"""
-        response = mock.MagicMock()
-        response.status_code = 200
-        response.json.return_value = [{"sha": "0123456789abcdef"}]
-        mock_requests_get.return_value = response
-        result = get_last_commit(fake_github_config, "someone", "one-repo")
-        self.assertEqual(result, "0123456789abcdef")
-
-    @mock.patch("requests.get")
-    def test_get_last_commit_custom_branch(self, mock_requests_get):
-        """Test getting commit sha for latest commit on a specific branch"""
-        response = mock.MagicMock()
-        response.status_code = 200
-        response.json.return_value = [{"sha": "0123456789abcdef"}]
-        mock_requests_get.return_value = response
-        result = get_last_commit(
-            fake_github_config, "someone", "one-repo", "not-default-branch"
-        )
-        self.assertEqual(result, "0123456789abcdef")
-
-    @mock.patch("requests.get")
-    def test_get_last_commit_not_found(self, mock_requests_get):
-        """Getting the commit sha for latest commit fails if no commits"""
-        response = mock.MagicMock()
-        response.status_code = 404
-        response.json.return_value = {"message": "nope"}
-        mock_requests_get.return_value = response
-        with self.assertRaises(GitHubError):
-            get_last_commit(fake_github_config, "someone", "one-repo")
-
-    @mock.patch("requests.get")
-    def test_get_commits_between(self, mock_requests_get):
-        """Test getting commits between two commits"""
-        response = mock.MagicMock()
-        response.status_code = 200
-        response.json.return_value = {
+
+
+@mock.patch("requests.Session.get")
+def test_get_last_commit_exists(
+    mock_requests_get, fake_github_config, make_response
+):
+    """Test getting commit sha for latest commit on the default branch"""
+    response = make_response([{"sha": "0123456789abcdef"}])
+    mock_requests_get.return_value = response
+    result = get_last_commit(fake_github_config, "someone", "one-repo")
+    assert result == "0123456789abcdef"
+
+
+@mock.patch("requests.Session.get")
+def test_get_last_commit_custom_branch(
+    mock_requests_get, fake_github_config, make_response
+):
+    """Test getting commit sha for latest commit on a specific branch"""
+    response = make_response([{"sha": "0123456789abcdef"}])
+    mock_requests_get.return_value = response
+    result = get_last_commit(
+        fake_github_config, "someone", "one-repo", "not-default-branch"
+    )
+    assert result == "0123456789abcdef"
+
+
+@mock.patch("requests.Session.get")
+def test_get_last_commit_not_found(
+    mock_requests_get, fake_github_config, make_response
+):
+    """Getting the commit sha for latest commit fails if no commits"""
+    response = make_response({"message": "nope"}, status_code=404)
+    mock_requests_get.return_value = response
+    with pytest.raises(GitHubError):
+        get_last_commit(fake_github_config, "someone", "one-repo")
+
+
+@mock.patch("requests.Session.get")
+def test_get_last_tag(mock_requests_get, fake_github_config, make_response):
+    """Test getting the latest tag only requests one tag"""
+    response = make_response([{"name": "0.1.0"}])
+    mock_requests_get.return_value = response
+    result = get_last_tag(fake_github_config, "someone", "one-repo")
+    assert result == "0.1.0"
+    assert mock_requests_get.call_args[1]["params"] == {"per_page": 1}
+
+
+@mock.patch("requests.Session.get")
+def test_get_commits_between(
+    mock_requests_get, fake_github_config, make_response
+):
+    """Test getting commits between two commits"""
+    response = make_response(
+        {
             "commits": [
                 {"sha": "0123456789abcdef", "commit": {"message": "Foo"}},
                 {"sha": "123456789abcdef0", "commit": {"message": "Bar"}},
             ]
         }
-        mock_requests_get.return_value = response
-        result = get_commits_between(
+    )
+    mock_requests_get.return_value = response
+    result = get_commits_between(
+        fake_github_config, "someone", "one-repo", "one", "two"
+    )
+    assert result == [("0123456789abcdef", "Foo"), ("123456789abcdef0", "Bar")]
+
+
+@mock.patch("changelog.COMPARE_PAGE_SIZE", 2)
+@mock.patch("requests.Session.get")
+def test_get_commits_between_paginated(
+    mock_requests_get, fake_github_config, make_response
+):
+    """Test getting commits between two commits over several pages"""
+    first_response = make_response(
+        {
+            "total_commits": 3,
+            "commits": [
+                {"sha": "0123456789abcdef", "commit": {"message": "Foo"}},
+                {"sha": "123456789abcdef0", "commit": {"message": "Bar"}},
+            ],
+        }
+    )
+    second_response = make_response(
+        {
+            "total_commits": 3,
+            "commits": [
+                {"sha": "23456789abcdef01", "commit": {"message": "Baz"}},
+            ],
+        }
+    )
+    mock_requests_get.side_effect = [first_response, second_response]
+    result = get_commits_between(
+        fake_github_config, "someone", "one-repo", "one", "two"
+    )
+    assert result == [
+        ("0123456789abcdef", "Foo"),
+        ("123456789abcdef0", "Bar"),
+        ("23456789abcdef01", "Baz"),
+    ]
+    assert mock_requests_get.call_args[1]["params"] == {
+        "per_page": 2,
+        "page": 2,
+    }
+
+
+@mock.patch("changelog.COMPARE_PAGE_SIZE", 1)
+@mock.patch("requests.Session.get")
+def test_iter_commits_between(
+    mock_requests_get, fake_github_config, make_response
+):
+    """Test the next page of commits is only requested when needed"""
+    mock_requests_get.return_value = make_response(
+        {
+            "total_commits": 2,
+            "commits": [
+                {"sha": "0123456789abcdef", "commit": {"message": "Foo"}}
+            ],
+        }
+    )
+    commits = iter_commits_between(
+        fake_github_config, "someone", "one-repo", "one", "two"
+    )
+    assert next(commits) == ("0123456789abcdef", "Foo")
+    assert mock_requests_get.call_count == 1
+    assert len(list(commits)) == 1
+    assert mock_requests_get.call_count == 2
+
+
+@mock.patch("changelog.COMPARE_PAGE_SIZE", 1)
+@mock.patch("requests.Session.get")
+def test_get_commits_between_without_total(
+    mock_requests_get, fake_github_config, make_response
+):
+    """Test commits are paginated until a short page without a total"""
+    mock_requests_get.side_effect = [
+        make_response({"commits": [{"sha": sha, "commit": {"message": m}}]})
+        for sha, m in [
+            ("0123456789abcdef", "Foo"),
+            ("123456789abcdef0", "Bar"),
+        ]
+    ] + [make_response({"commits": []})]
+    result = get_commits_between(
+        fake_github_config, "someone", "one-repo", "one", "two"
+    )
+    assert result == [("0123456789abcdef", "Foo"), ("123456789abcdef0", "Bar")]
+    assert mock_requests_get.call_count == 3
+
+
+@mock.patch("requests.Session.get")
+def test_get_commits_between_no_commits(
+    mock_requests_get, fake_github_config, make_response
+):
+    """Test when there are no commits in the data"""
+    response = make_response({})
+    mock_requests_get.return_value = response
+    with pytest.raises(GitHubError):
+        get_commits_between(
             fake_github_config, "someone", "one-repo", "one", "two"
         )
-        self.assertEqual(
-            result, [("0123456789abcdef", "Foo"), ("123456789abcdef0", "Bar")]
-        )
 
-    @mock.patch("requests.get")
-    def test_get_commits_between_no_commits(self, mock_requests_get):
-        """Test when there are no commits in the data"""
-        response = mock.MagicMock()
-        response.status_code = 200
-        response.json.return_value = {}
-        mock_requests_get.return_value = response
-        with self.assertRaises(GitHubError):
-            get_commits_between(
-                fake_github_config, "someone", "one-repo", "one", "two"
-            )
 
-    @mock.patch("requests.get")
-    def test_get_commits_between_not_found(self, mock_requests_get):
-        """Test when one commit is not found"""
-        response = mock.MagicMock()
-        response.status_code = 404
-        response.json.return_value = {"message": "nope"}
-        mock_requests_get.return_value = response
-        with self.assertRaises(GitHubError):
-            get_commits_between(
-                fake_github_config, "someone", "one-repo", "one", "two"
-            )
+@mock.patch("requests.Session.get")
+def test_get_commits_between_not_found(
+    mock_requests_get, fake_github_config, make_response
+):
+    """Test when one commit is not found"""
+    response = make_response({"message": "nope"}, status_code=404)
+    mock_requests_get.return_value = response
+    with pytest.raises(GitHubError):
+        get_commits_between(
+            fake_github_config, "someone", "one-repo", "one", "two"
+        )
+
 
-    @mock.patch("requests.get")
-    def test_get_pr_details(self, mock_requests_get):
-        """Test getting the details of the PR numbered"""
-        response = mock.MagicMock()
-        response.status_code = 200
-        response.json.return_value = {
+@mock.patch("requests.Session.get")
+def test_get_pr_details(mock_requests_get, fake_github_config, make_response):
+    """Test getting the details of the PR numbered"""
+    response = make_response(
+        {
             "body": "Here comes the details of the PR",
             "labels": [{"name": "test"}, {"name": "BREAKING"}],
         }
-        mock_requests_get.return_value = response
-        result = get_pr_details(fake_github_config, "someone", "one-repo", "1")
-        self.assertEqual(
-            result,
-            PullRequestDetails(
-                "Here comes the details of the PR", ["test", "BREAKING"]
-            ),
-        )
+    )
+    mock_requests_get.return_value = response
+    result = get_pr_details(fake_github_config, "someone", "one-repo", 1)
+    assert result == PullRequestDetails(
+        "Here comes the details of the PR", ["test", "BREAKING"]
+    )
 
-    @mock.patch("requests.get")
-    def test_get_pr_details_not_found(self, mock_requests_get):
-        """Test getting the body of the PR numbered"""
-        response = mock.MagicMock()
-        response.status_code = 404
-        response.json.return_value = {"message": "Not Found"}
-        mock_requests_get.return_value = response
-        with self.assertRaises(GitHubError):
-            get_pr_details(fake_github_config, "someone", "one-repo", "1")
-
-    def test_is_pr_merge(self):
-        """Test our PR extractor with merge PRa"""
-        message = "Merge pull request #1234 from some/branch\n\nMy Title"
-        self.assertTrue(is_pr(message))
-
-    def test_is_pr_squash(self):
-        """Test our PR extractor with squash-and-merge PR"""
-        message = "My Title (#1234)\n\nMy description"
-        self.assertTrue(is_pr(message))
-
-    def test_is_pr_not_pr(self):
-        """Test our PR extractor with non-PR message"""
-        message = "I made some changes!"
-        self.assertFalse(is_pr(message))
-
-    def test_is_pr_no_number(self):
-        """Test our PR extractor with non-PR message"""
-        message = "Merge pull request from some/branch\n\nMy Title"
-        self.assertFalse(is_pr(message))
-
-    def test_is_pr_potential_squash(self):
-        """Test our PR extractor with non-squashed PR message"""
-        message = "Some title addresses bug (#345)"
-        self.assertTrue(is_pr(message))
-
-    def test_extract_pr_merge(self):
-        """Test our PR extractor with merge PRa"""
-        message = "Merge pull request #1234 from some/branch\n\nMy Title"
-        result = extract_pr(message)
-        self.assertEqual(result.number, "1234")
-        self.assertEqual(result.title, "My Title")
-
-    def test_extract_pr_squash(self):
-        """Test our PR extractor with squash-and-merge PR"""
-        message = "My Title (#1234)\n\nMy description"
-        result = extract_pr(message)
-        self.assertEqual(result.number, "1234")
-        self.assertEqual(result.title, "My Title")
-
-    def test_extract_pr_not_pr(self):
-        """Test our PR extractor with non-PR message"""
-        message = "I made some changes!"
-        with self.assertRaises(Exception):
-            extract_pr(message)
-
-    def test_extract_pr_no_number(self):
-        """Test our PR extractor with non-PR message"""
-        message = "Merge pull request from some/branch\n\nMy Title"
-        with self.assertRaises(Exception):
-            extract_pr(message)
-
-    def test_extract_pr_potential_squash(self):
-        """Test our PR extractor with non-squashed PR message"""
-        message = "Some title addresses bug (#345)"
-        result = extract_pr(message)
-        self.assertEqual(result.number, "345")
-        self.assertEqual(result.title, "Some title addresses bug")
-
-    def test_format_changes_uses_correct_base_url(self):
-        """Test format_changes() with a custom GitHub base url"""
-        github_config = get_github_config(
-            "https://github.company.com",
-            "https://github.company.com/api/v3",
-            token=None,
-        )
+
+@mock.patch("requests.Session.get")
+def test_get_pr_details_not_found(
+    mock_requests_get, fake_github_config, make_response
+):
+    """Test getting the body of the PR numbered"""
+    response = make_response({"message": "Not Found"}, status_code=404)
+    mock_requests_get.return_value = response
+    with pytest.raises(GitHubError):
+        get_pr_details(fake_github_config, "someone", "one-repo", 1)
+
+
+def test_get_graphql_url(fake_github_config):
+    """Test the GraphQL endpoint for public GitHub and GitHub Enterprise"""
+    github_config = get_github_config(
+        "https://github.company.com",
+        "https://github.company.com/api/v3",
+        token=None,
+    )
+    assert (
+        get_graphql_url(fake_github_config) == "https://api.github.com/graphql"
+    )
+    graphql_url = get_graphql_url(github_config)
+    assert graphql_url == "https://github.company.com/api/graphql"
+
+
+@mock.patch("changelog.GRAPHQL_BATCH_SIZE", 2)
+@mock.patch("requests.Session.post")
+def test_get_pr_details_batch(
+    mock_requests_post, fake_github_config, make_response
+):
+    """Test getting the details of several PRs in batched queries"""
+    first_response = make_response(
+        {
+            "data": {
+                "repository": {
+                    "pr1": {
+                        "body": "First PR",
+                        "labels": {"nodes": [{"name": "fix"}]},
+                    },
+                    "pr2": {"body": None, "labels": {"nodes": []}},
+                }
+            }
+        }
+    )
+    second_response = make_response(
+        {
+            "data": {
+                "repository": {
+                    "pr3": {
+                        "body": "Third PR",
+                        "labels": {"nodes": [{"name": "major"}]},
+                    },
+                }
+            }
+        }
+    )
+    mock_requests_post.side_effect = [first_response, second_response]
+    result = get_pr_details_batch(
+        fake_github_config, "someone", "one-repo", [1, 2, 3]
+    )
+    assert result == {
+        1: PullRequestDetails("First PR", ["fix"]),
+        2: PullRequestDetails(None, []),
+        3: PullRequestDetails("Third PR", ["major"]),
+    }
+    assert mock_requests_post.call_count == 2
+    assert mock_requests_post.call_args[1]["json"]["variables"] == {
+        "owner": "someone",
+        "repo": "one-repo",
+    }
+
+
+@mock.patch("requests.Session.post")
+def test_get_pr_details_batch_errors(
+    mock_requests_post, fake_github_config, make_response
+):
+    """Test GraphQL errors are raised as a GitHubError"""
+    response = make_response(
+        {
+            "data": {"repository": {"pr1": None}},
+            "errors": [{"message": "Could not resolve to a PullRequest"}],
+        }
+    )
+    mock_requests_post.return_value = response
+    with pytest.raises(GitHubError):
+        get_pr_details_batch(fake_github_config, "someone", "one-repo", [1])
+
+
+@mock.patch("changelog.GRAPHQL_BATCH_SIZE", 1)
+@mock.patch("requests.Session.post")
+def test_iter_pr_details(
+    mock_requests_post, fake_github_config, make_response
+):
+    """Test PR details are yielded as each batch arrives"""
+    response = make_response(
+        {
+            "data": {
+                "repository": {
+                    "pr1": {"body": "A PR", "labels": {"nodes": []}},
+                    "pr2": {"body": "A PR", "labels": {"nodes": []}},
+                }
+            }
+        }
+    )
+    mock_requests_post.return_value = response
+    details = iter_pr_details(
+        fake_github_config, "someone", "one-repo", [1, 2]
+    )
+    assert next(details) == PullRequestDetails("A PR", [])
+    assert mock_requests_post.call_count == 1
+    assert next(details) == PullRequestDetails("A PR", [])
+    assert mock_requests_post.call_count == 2
+
+
+def test_extract_changelog():
+    """Test extracting the changelog line from a PR body"""
+    body = "My description\n\nCHANGELOG: Added some stuff\nMore text"
+    assert extract_changelog(body) == "Added some stuff"
+
+
+def test_extract_changelog_missing():
+    """Test PR bodies without a changelog line"""
+    assert extract_changelog(None) is None
+    assert extract_changelog("My description") is None
+    assert extract_changelog("Fixes the CHANGELOG: typo") is None
+
+
+@pytest.mark.parametrize(
+    "message,expected",
+    [
+        # merge PR
+        ("Merge pull request #1234 from some/branch\n\nMy Title", True),
+        # squash-and-merge PR
+        ("My Title (#1234)\n\nMy description", True),
+        # non-PR message
+        ("I made some changes!", False),
+        # merge message without a PR number
+        ("Merge pull request from some/branch\n\nMy Title", False),
+        # non-squashed message that looks like a squashed PR
+        ("Some title addresses bug (#345)", True),
+    ],
+)
+def test_is_pr(message, expected):
+    """Test our PR detector with merge, squash and non-PR messages"""
+    assert is_pr(message) == expected
+
+
+@pytest.mark.parametrize(
+    "message,number,title",
+    [
+        (
+            "Merge pull request #1234 from some/branch\n\nMy Title",
+            1234,
+            "My Title",
+        ),
+        ("My Title (#1234)\n\nMy description", 1234, "My Title"),
+        ("Some title addresses bug (#345)", 345, "Some title addresses bug"),
+    ],
+)
+def test_extract_pr(message, number, title):
+    """Test our PR extractor with merge and squash PRs"""
+    result = extract_pr(message)
+    assert result.number == number
+    assert result.title == title
+
+
+@pytest.mark.parametrize(
+    "message",
+    [
+        "I made some changes!",
+        "Merge pull request from some/branch\n\nMy Title",
+    ],
+)
+def test_extract_pr_not_pr(message):
+    """Test our PR extractor with non-PR messages"""
+    with pytest.raises(Exception):
+        extract_pr(message)
+
+
+def test_parse_pr_not_pr():
+    """Test parsing a non-PR message returns None"""
+    assert parse_pr("I made some changes!") is None
+
+
+def test_parse_pr_number_in_body():
+    """Test PR numbers are only matched on the first line of a message"""
+    message = "I made some changes!\n\nSome title addresses bug (#345)"
+    assert parse_pr(message) is None
+
+
+def test_format_changes_uses_correct_base_url():
+    """Test format_changes() with a custom GitHub base url"""
+    github_config = get_github_config(
+        "https://github.company.com",
+        "https://github.company.com/api/v3",
+        token=None,
+    )
+    prs = [
+        ExtendedPullRequest(
+            PullRequest(1, "first"), PullRequestDetails(None, None)
+        ),
+        ExtendedPullRequest(
+            PullRequest(2, "second"), PullRequestDetails(None, None)
+        ),
+    ]
+    actual = format_changes(
+        github_config, "owner", "a-repo", prs, markdown=True
+    )
+    expected = [
+        "MINOR RELEASE",
+        "- first [#1](https://github.company.com/owner/a-repo/pull/1)",
+        "- second [#2](https://github.company.com/owner/a-repo/pull/2)",
+    ]
+    assert actual == expected
+
+
+def test_format_changes_release_level(fake_github_config):
+    """Test the release level is the highest level of the PR labels"""
+    labels_to_outputs = [
+        [[["fix"], ["hotfix", "patch"]], "PATCH RELEASE"],
+        [[["fix"], []], "MINOR RELEASE"],
+        [[["fix", "documentation"]], "MINOR RELEASE"],
+        [[["feature"], ["fix"]], "MINOR RELEASE"],
+        [[["fix"], ["breaking", "feature"]], "MAJOR RELEASE"],
+    ]
+    for labels, expected_output in labels_to_outputs:
         prs = [
             ExtendedPullRequest(
-                PullRequest(1, "first"), PullRequestDetails(None, None)
-            ),
-            ExtendedPullRequest(
-                PullRequest(2, "second"), PullRequestDetails(None, None)
-            ),
-        ]
-        actual = format_changes(
-            github_config, "owner", "a-repo", prs, markdown=True
-        )
-        expected = [
-            "MINOR RELEASE",
-            "- first [#1](https://github.company.com/owner/a-repo/pull/1)",
-            "- second [#2](https://github.company.com/owner/a-repo/pull/2)",
-        ]
-        self.assertEqual(actual, expected)
-
-    @mock.patch("requests.get")
-    def test_generate_changelog(self, mock_requests_get):
-        """Test the main method that generates a changelog"""
-        responses = []
-
-        get_last_tag_response = mock.MagicMock()
-        get_last_tag_response.status_code = 200
-        get_last_tag_response.json.return_value = [
-            {"name": "0.1.0", "commit": {"sha": "4"}},
-            {"name": "0.0.1", "commit": {"sha": "1"}},
+                PullRequest(1, "first"),
+                PullRequestDetails(None, pr_labels),
+            )
+            for pr_labels in labels
         ]
-        responses.append(get_last_tag_response)
+        actual = format_changes(fake_github_config, "owner", "a-repo", prs)
+        assert actual[0] == expected_output
+
 
-        get_commit_for_tag_response = mock.MagicMock()
-        get_commit_for_tag_response.status_code = 200
-        get_commit_for_tag_response.json.return_value = {
-            "object": {"type": "commit", "sha": "4"}
+@mock.patch("requests.Session.post")
+@mock.patch("requests.Session.get")
+def test_fetch_changes_duplicate_prs(
+    mock_requests_get,
+    mock_requests_post,
+    fake_github_config,
+    make_response,
+    serve_graphql,
+):
+    """Test a PR referenced by several commits is only looked up once"""
+    get_commits_between_response = make_response(
+        {
+            "commits": [
+                {"sha": "2", "commit": {"message": "My Title (#7)"}},
+                {"sha": "3", "commit": {"message": "My Title (#7)"}},
+            ]
         }
-        responses.append(get_commit_for_tag_response)
-
-        get_last_commit_response = mock.MagicMock()
-        get_last_commit_response.status_code = 200
-        get_last_commit_response.json.return_value = [
-            {
-                "sha": "10",
-                "commit": {
-                    "message": "Merge pull request #1234 from some/branch"
-                    "\n\nMy Title"
-                },
-            },
-            {
-                "sha": "9",
-                "commit": {"message": "My Title (#1234)\n\nMy description"},
-            },
-            {
-                "sha": "8",
-                "commit": {"message": "I made some changes!"},
-            },
-            {
-                "sha": "7",
-                "commit": {
-                    "message": "Merge pull request from some/branch"
-                    "\n\nMy Title"
-                },
-            },
-            {
-                "sha": "6",
-                "commit": {"message": "Some title addresses bug (#345)"},
-            },
-            {
-                "sha": "5",
-                "commit": {
-                    "message": "Merge pull request #1234 from some/branch"
-                    "\n\nMy Title"
+    )
+    get_pr_details_batch_response = make_response(
+        {
+            "data": {
+                "repository": {
+                    "pr7": {
+                        "body": "PR body content",
+                        "labels": {"nodes": []},
+                    }
+                }
+            }
+        }
+    )
+
+    mock_requests_get.return_value = get_commits_between_response
+    mock_requests_post.side_effect = serve_graphql(
+        {"0.0.1": "1", "0.1.0": "3"}, get_pr_details_batch_response
+    )
+    result = fetch_changes(
+        fake_github_config, "someone", "one-repo", "0.0.1", "0.1.0"
+    )
+
+    assert result == [
+        ExtendedPullRequest(
+            PullRequest(7, "My Title"),
+            PullRequestDetails("PR body content", []),
+        )
+    ]
+    assert mock_requests_post.call_count == 3
+    query = mock_requests_post.call_args[1]["json"]["query"]
+    assert query.count("pullRequest(") == 1
+
+
+@mock.patch("requests.Session.post")
+@mock.patch("requests.Session.get")
+def test_fetch_changes_duplicate_prs_rest(
+    mock_requests_get,
+    mock_requests_post,
+    fake_github_config,
+    make_response,
+    serve_fixture,
+    serve_graphql,
+):
+    """Test a duplicated PR is only requested once without GraphQL"""
+    mock_requests_get.side_effect = serve_fixture(
+        {
+            "get": {
+                "repos/someone/one-repo/compare/1...3": {
+                    "commits": [
+                        {"sha": "2", "commit": {"message": "Title (#7)"}},
+                        {"sha": "3", "commit": {"message": "Title (#7)"}},
+                    ]
                 },
-            },
-            {
-                "sha": "4",
-                "commit": {"message": "My Title (#1234)\n\nMy description"},
-            },
-            {
-                "sha": "3",
-                "commit": {"message": "I made some changes!"},
-            },
-            {
-                "sha": "2",
-                "commit": {
-                    "message": "Merge pull request from some/branch"
-                    "\n\nMy Title"
+                "repos/someone/one-repo/pulls/7": {
+                    "body": "PR body content",
+                    "labels": [],
                 },
-            },
-            {
-                "sha": "1",
-                "commit": {"message": "Some title addresses bug (#345)"},
-            },
-        ]
-        responses.append(get_last_commit_response)
+            }
+        },
+        PUBLIC_GITHUB_API_URL,
+    )
+    mock_requests_post.side_effect = serve_graphql(
+        {"0.0.1": "1", "0.1.0": "3"},
+        make_response({"message": "Not Found"}, status_code=404),
+    )
+    result = fetch_changes(
+        fake_github_config, "someone", "one-repo", "0.0.1", "0.1.0"
+    )
 
-        get_commits_between_response = mock.MagicMock()
-        get_commits_between_response.status_code = 200
-        get_commits_between_response.json.return_value = {
+    assert len(result) == 1
+    pulls_url = PUBLIC_GITHUB_API_URL + "/repos/someone/one-repo/pulls/7"
+    assert [args[0][0] for args in mock_requests_get.call_args_list].count(
+        pulls_url
+    ) == 1
+
+
+@mock.patch("requests.Session.post")
+@mock.patch("requests.Session.get")
+def test_fetch_changes_no_prs(
+    mock_requests_get,
+    mock_requests_post,
+    fake_github_config,
+    make_response,
+    serve_graphql,
+):
+    """Test PR details aren't fetched when no commit is a PR merge"""
+    get_commits_between_response = make_response(
+        {
             "commits": [
                 {
-                    "sha": "10",
-                    "commit": {
-                        "message": "Merge pull request #10 from some/branch"
-                        "\n\nMy Title"
-                    },
-                },
-                {
-                    "sha": "9",
-                    "commit": {"message": "My Title (#9)\n\nMy description"},
-                },
-                {
-                    "sha": "8",
+                    "sha": "2",
                     "commit": {"message": "I made some changes!"},
                 },
-                {
-                    "sha": "7",
-                    "commit": {
-                        "message": "Merge pull request from some/branch"
-                        "\n\nMy Title"
-                    },
-                },
-                {
-                    "sha": "6",
-                    "commit": {"message": "Some title addresses bug (#6)"},
-                },
-                {
-                    "sha": "5",
-                    "commit": {
-                        "message": "Merge pull request #5 from some/branch"
-                        "\n\nMy Title"
-                    },
-                },
             ]
         }
-        responses.append(get_commits_between_response)
+    )
 
-        get_pr_details_response = mock.MagicMock()
-        get_pr_details_response.status_code = 200
-        get_pr_details_response.json.return_value = {
-            "body": "My Title #10\n\nCHANGELOG: Specific Changelog",
-            "labels": [],
-        }
-        responses.append(get_pr_details_response)
+    mock_requests_get.return_value = get_commits_between_response
+    mock_requests_post.side_effect = serve_graphql(
+        {"0.0.1": "1", "0.1.0": "2"}
+    )
+    with pytest.raises(NoPullRequestsError):
+        fetch_changes(
+            fake_github_config, "someone", "one-repo", "0.0.1", "0.1.0"
+        )
+    assert mock_requests_post.call_count == 2
 
-        get_pr_details_response = mock.MagicMock()
-        get_pr_details_response.status_code = 200
-        get_pr_details_response.json.return_value = {
-            "body": "PR body content",
-            "labels": [],
-        }
-        responses.append(get_pr_details_response)
 
-        get_pr_details_response = mock.MagicMock()
-        get_pr_details_response.status_code = 200
-        get_pr_details_response.json.return_value = {
-            "body": "PR body content",
-            "labels": [],
-        }
-        responses.append(get_pr_details_response)
+@mock.patch("changelog.fetch_changes")
+def test_fetch_changes_async(mock_fetch_changes, fake_github_config):
+    """Test fetching the changes of several repos concurrently"""
+    mock_fetch_changes.side_effect = lambda config, owner, repo, *a: [repo]
 
-        get_pr_details_response = mock.MagicMock()
-        get_pr_details_response.status_code = 200
-        get_pr_details_response.json.return_value = {
-            "body": "PR body content",
-            "labels": [],
-        }
-        responses.append(get_pr_details_response)
-
-        mock_requests_get.side_effect = responses
-        result = generate_changelog(
-            "someone",
-            "one-repo",
-            github_base_url="https://github.com",
-            github_api_url="https://api.github.com",
+    async def fetch_all():
+        return await asyncio.gather(
+            fetch_changes_async(fake_github_config, "someone", "one-repo"),
+            fetch_changes_async(fake_github_config, "someone", "two-repo"),
         )
 
-        self.assertEqual(
-            result,
-            (
-                "MINOR RELEASE\n"
-                "- My Title #5\n"
-                "- Some title addresses bug #6\n"
-                "- My Title #9\n"
-                "- Specific Changelog #10"
-            ),
-        )
+    result = asyncio.run(fetch_all())
+    assert result == [["one-repo"], ["two-repo"]]
+    mock_fetch_changes.assert_any_call(
+        fake_github_config,
+        "someone",
+        "one-repo",
+        None,
+        None,
+        DEFAULT_BRANCH,
+        False,
+    )
+
+
+@mock.patch("requests.Session.get")
+def test_generate_changelog_no_changes(mock_requests_get, make_response):
+    """Test nothing is compared when both tags are on the same commit"""
+    get_commit_for_tag_response = make_response(
+        {"object": {"type": "commit", "sha": "1"}}
+    )
+
+    mock_requests_get.return_value = get_commit_for_tag_response
+    result = generate_changelog(
+        "someone",
+        "one-repo",
+        "0.1.0",
+        "0.1.0",
+        github_base_url="https://github.com",
+        github_api_url="https://api.github.com",
+    )
+
+    assert result == ""
+    assert mock_requests_get.call_count == 2
+
+
+@mock.patch("requests.Session.post")
+@mock.patch("requests.Session.get")
+def test_generate_changelog(
+    mock_requests_get,
+    mock_requests_post,
+    load_fixture,
+    make_response,
+    serve_fixture,
+):
+    """Test the main method that generates a changelog"""
+    fixture = load_fixture("generate_changelog.json")
+
+    mock_requests_get.side_effect = serve_fixture(
+        fixture, "https://api.github.com"
+    )
+    # The tag is resolved with GraphQL instead of REST
+    mock_requests_post.side_effect = [
+        make_response(fixture["post"]["tag"]),
+        make_response(fixture["post"]["pr_details"]),
+    ]
+    result = generate_changelog(
+        "someone",
+        "one-repo",
+        github_base_url="https://github.com",
+        github_api_url="https://api.github.com",
+        github_token="fake-github-token",
+    )
+
+    assert result == (
+        "MINOR RELEASE\n"
+        "- My Title #5\n"
+        "- Some title addresses bug #6\n"
+        "- My Title #9\n"
+        "- Specific Changelog #10"
+    )
+    assert mock_requests_post.call_count == 2
+
+
+@mock.patch("requests.Session.post")
+@mock.patch("requests.Session.get")
+def test_generate_changelog_rest_fallback(
+    mock_requests_get,
+    mock_requests_post,
+    load_fixture,
+    make_response,
+    serve_fixture,
+):
+    """Test PR details are fetched with REST when GraphQL is unavailable"""
+    fixture = load_fixture("generate_changelog.json")
+
+    # PR details are fetched concurrently, so they are served by url
+    mock_requests_get.side_effect = serve_fixture(
+        fixture, "https://github.company.com/api/v3"
+    )
+    mock_requests_post.return_value = make_response(
+        {"message": "Not Found"}, status_code=404
+    )
+    result = generate_changelog(
+        "someone",
+        "one-repo",
+        github_base_url="https://github.company.com",
+        github_api_url="https://github.company.com/api/v3",
+        github_token="fake-github-token",
+    )
+
+    assert result == (
+        "MINOR RELEASE\n"
+        "- My Title #5\n"
+        "- Some title addresses bug #6\n"
+        "- My Title #9\n"
+        "- Specific Changelog #10"
+    )
+    graphql_url = mock_requests_post.call_args[0][0]
+    assert graphql_url == "https://github.company.com/api/graphql"
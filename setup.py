@@ -16,17 +16,22 @@ setup(
     long_description_content_type="text/markdown",
     include_package_data=True,
     packages=find_packages(),
+    package_data={"changelog.tests": ["fixtures/*.json"]},
+    python_requires=">=3.7",
     install_requires=[
         "requests>=2.13",
     ],
     extras_require={
+        "orjson": [
+            "orjson>=3.0",
+        ],
         "testing": [
-            "mock>=2.0.0",
             "coverage>=3.7.0",
             "flake8>=2.2.0",
+            "pytest>=6.0",
+            "pytest-xdist>=2.0",
         ],
     },
-    test_suite="changelog.tests",
     entry_points={
         "console_scripts": [
             "changelog = changelog:main",